@@ -0,0 +1,322 @@
+"""
+Shared machinery to estimate and apply NHSN HRD backfill from the archived preliminary snapshots.
+
+The expensive parquet decoding and sliding-window construction are independent of the chosen
+backfill window length and priors, so sweeps over those settings reuse the load through the
+on-disk snapshot cache instead of re-decoding the archive per variant.
+"""
+
+__author__      = "T.W. Alleman"
+__copyright__   = "Copyright (c) 2025 by T.W. Alleman, IDD Group (JHUBSPH) & Bento Lab (Cornell CVM). All Rights Reserved."
+
+##################
+## Dependencies ##
+##################
+
+import os
+import re
+import glob
+import warnings
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+from scipy.special import betaincinv
+from concurrent.futures import ThreadPoolExecutor
+
+# Columns needed to estimate the backfill; all other columns are only relevant for the latest snapshot
+backfill_columns = ['date', 'name_state', 'fips_state', 'influenza admissions']
+
+
+####################
+## Main Functions ##
+####################
+
+
+def load_snapshots(archive_dir: str):
+    """
+    Load all archived preliminary snapshots, oldest to newest
+
+    input
+    -----
+
+    archive_dir: str
+        Folder containing the archived preliminary .parquet.gzip snapshots.
+
+    output
+    ------
+
+    parquet_files: list
+        Sorted paths of the archived snapshot files.
+
+    dfs: list
+        One pd.DataFrame per snapshot, restricted to the backfill columns and to the rows at the
+        (up to three) focal dates the snapshot observes, indexed on the (sorted) date.
+
+    notes
+    -----
+
+    Decoded snapshots are cached on disk inside the archive folder: only the newest file changes
+    week-to-week, so re-decoding the whole archive every run is wasted work. Cache entries are
+    keyed on the file's mtime so edits invalidate them. Files are independent and decompression
+    releases the GIL, so they are loaded in parallel (map preserves order).
+
+    Only the focal-date rows ever feed the window construction, so everything else is dropped
+    right after decoding: peak memory stays at ~3 reporting weeks per snapshot instead of the
+    full archive, whatever the archive grows to.
+    """
+
+    cache_dir = os.path.join(archive_dir, ".cache")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    def load_snapshot(file, observed_dates):
+        """Load one preliminary snapshot (backfill columns, focal-date rows only), memoized on disk"""
+        cache_path = os.path.join(cache_dir, f"{os.path.basename(file)}.{os.stat(file).st_mtime_ns}.win.pkl")
+        if os.path.exists(cache_path):
+            return pd.read_pickle(cache_path)
+        # single-threaded inner read; file-level parallelism is handled by the thread pool below
+        df = ds.dataset(file, format='parquet').to_table(columns=backfill_columns, use_threads=False).to_pandas()
+        # counts fit comfortably in 32-bit floats (NaNs preclude an integer dtype) and fips codes in
+        # 8 bits; narrower numeric columns halve the bandwidth of every downstream pass
+        df['influenza admissions'] = pd.to_numeric(df['influenza admissions'], downcast='float')
+        df['fips_state'] = pd.to_numeric(df['fips_state'], downcast='integer')
+        # ~50 unique state names: 1-byte categorical codes instead of repeated strings
+        df['name_state'] = df['name_state'].astype('category')
+        df = df.set_index('date', drop=False).sort_index()
+        df = df.loc[[d for d in observed_dates if d in df.index]]
+        # drop cache entries for older mtimes of this file before writing the fresh one
+        for stale in glob.glob(os.path.join(cache_dir, f"{os.path.basename(file)}.*.pkl")):
+            os.remove(stale)
+        df.to_pickle(cache_path)
+        return df
+
+    parquet_files = sorted(glob.glob(os.path.join(archive_dir, "*.gzip")))
+    # snapshot j observes its own focal date and re-observes those of its two predecessors
+    focal_dates = parse_focal_dates(parquet_files)
+    observed = [focal_dates[max(0, j-2):j+1] for j in range(len(parquet_files))]
+    with ThreadPoolExecutor(max_workers=min(8, len(parquet_files))) as executor:
+        dfs = list(executor.map(load_snapshot, parquet_files, observed))
+
+    # align the categorical state dtype across snapshots, so concatenating slices keeps integer
+    # codes (concatenating mismatched per-file categories silently falls back to object strings)
+    state_dtype = pd.CategoricalDtype(pd.api.types.union_categoricals([df['name_state'].array for df in dfs],
+                                                                      sort_categories=True).categories)
+    for df in dfs:
+        df['name_state'] = df['name_state'].astype(state_dtype)
+    return parquet_files, dfs
+
+
+def parse_focal_dates(parquet_files: list) -> list:
+    """
+    Read each snapshot's focal (most recent) reporting date off its archive file name
+
+    input
+    -----
+
+    parquet_files: list
+        Sorted paths of the archived snapshot files.
+
+    output
+    ------
+
+    focal_dates: list
+        One pd.Timestamp per snapshot.
+
+    notes
+    -----
+
+    The fetch script names every snapshot after its CDC FluSight reference date, which is one week
+    past the last reporting date it contains, so no snapshot needs to be opened (or scanned) to
+    recover its focal date.
+    """
+    return [pd.Timestamp(re.search(r'reference-date-(\d{4}-\d{2}-\d{2})', os.path.basename(file)).group(1))
+            - pd.Timedelta(weeks=1) for file in parquet_files]
+
+
+def build_window_frame(dfs: list, focal_dates: list) -> pd.DataFrame:
+    """
+    Build the sliding-window frame pairing every focal date with its two re-observations
+
+    input
+    -----
+
+    dfs: list
+        Snapshots as returned by `load_snapshots()`.
+
+    focal_dates: list
+        Each snapshot's focal reporting date (see `parse_focal_dates()`).
+
+    output
+    ------
+
+    abs_backfill: pd.DataFrame
+        One row per (focal date, state) with columns 'influenza_admissions_0/1/2' holding the
+        admissions reported 0, 1 and 2 weeks after the focal date first appeared, plus a
+        'window' column holding the index of the snapshot that introduced the focal date.
+        Only focal dates that have been re-observed twice (complete windows) are included.
+    """
+
+    # Snapshots i+1 and i+2 re-observe focal date i
+    date_to_release = {d: i for i, d in enumerate(focal_dates)}
+    # only focal dates that have been re-observed twice form a complete backfill window
+    n_windows = len(dfs) - 3 + 1
+
+    # Build one long frame: the snapshots are already sliced to the focal dates they (re-)observe,
+    # so label every row with the number of weeks its focal date has been in the dataset (lag 0, 1
+    # or 2) and concatenate
+    slices = [df.assign(lag=j - df['date'].map(date_to_release)) for j, df in enumerate(dfs)]
+    long_df = pd.concat(slices, ignore_index=True)
+
+    # Pivot to one row per (focal date, state) with the week-0/1/2 observations as columns
+    abs_backfill = (
+        long_df
+        .set_index(['date', 'name_state', 'fips_state', 'lag'])['influenza admissions']
+        .unstack('lag')
+        .rename(columns=lambda k: f'influenza_admissions_{k}')
+        .reset_index()
+    )
+    abs_backfill['window'] = abs_backfill['date'].map(date_to_release)
+    # the youngest two focal dates have not been re-observed twice yet: drop their incomplete windows
+    return abs_backfill.loc[abs_backfill['window'] < n_windows]
+
+
+def estimate_backfill_posterior(sum_df: pd.DataFrame, a0_prior: float, b0_prior: float,
+                                a1_prior: float, b1_prior: float) -> pd.DataFrame:
+    """
+    Conjugate generalized Dirichlet-Multinomial update of the reporting completeness per state
+
+    input
+    -----
+
+    sum_df: pd.DataFrame
+        Window frame (see `build_window_frame()`) restricted to the windows to learn from.
+
+    a0_prior: float
+    b0_prior: float
+        Beta prior on the hazard of immediate reporting in week 0.
+
+    a1_prior: float
+    b1_prior: float
+        Beta prior on the hazard of reporting in week 1, given not reported in week 0.
+
+    output
+    ------
+
+    posterior: pd.DataFrame
+        One row per state with the per-lag count sums, the posterior mean completeness fractions
+        'p_02_mean'/'p_12_mean' and their 5/50/95% posterior quantiles.
+
+    notes
+    -----
+
+    Based on the work of https://academic.oup.com/biometrics/article/76/3/789/7429141#biom13188-sec-0050
+    """
+
+    # sum per state over factorized state codes; at ~50 states the pandas groupby setup cost
+    # outweighs the arithmetic (factorizing the Series reuses the categorical codes directly),
+    # and bincount sums in one contiguous pass where np.add.at pays for unbuffered scatter
+    codes, states = pd.factorize(sum_df['name_state'])
+    y0 = np.bincount(codes, weights=np.nan_to_num(sum_df['influenza_admissions_0'].to_numpy()), minlength=len(states))
+    y1 = np.bincount(codes, weights=np.nan_to_num(sum_df['influenza_admissions_1'].to_numpy()), minlength=len(states))
+    y2 = np.bincount(codes, weights=np.nan_to_num(sum_df['influenza_admissions_2'].to_numpy()), minlength=len(states))
+    posterior = pd.DataFrame({'name_state': states, 'y0_sum': y0, 'y1_sum': y1, 'y2_sum': y2})
+
+    # Convert cumulative counts into increments and totals
+    z0 = y0
+    z1 = y1 - y0
+    z2 = y2 - y1
+    n = z0 + z1 + z2
+
+    # Posterior updates (conjugate) and posterior means of hazards
+    a0_post = a0_prior + z0
+    b0_post = b0_prior + (n - z0)
+    a1_post = a1_prior + z1
+    b1_post = b1_prior + (n - z0 - z1)
+    v0_mean = a0_post / (a0_post + b0_post)
+    v1_mean = a1_post / (a1_post + b1_post)
+
+    # Completeness fractions (analytic); round and cap in place on one stacked array instead of a
+    # separate clip(round(...)) pass per column (hazards are positive, so only the upper cap matters)
+    p_means = np.stack((v0_mean, 1.0 - (1.0 - v0_mean) * (1.0 - v1_mean)))
+    np.round(p_means, 3, out=p_means)
+    np.minimum(p_means, 1.0, out=p_means)
+    posterior = posterior.assign(p_02_mean=p_means[0], p_12_mean=p_means[1])
+
+    # 90% credible intervals on the completeness fractions; p_02 = v0 is exactly Beta(a0_post, b0_post).
+    # p_12 = 1 - (1-v0)(1-v1) has no closed-form posterior, so the product (1-v0)(1-v1) is moment-matched
+    # to a Beta using its exact first two moments (v0 and v1 are independent a posteriori).
+    # Stack both blocks so all six quantiles come from one batched call; betaincinv is invoked
+    # directly, skipping the argument-validation and dispatch layers of scipy.stats.beta.ppf.
+    w_m1 = (b0_post / (a0_post + b0_post)) * (b1_post / (a1_post + b1_post))
+    w_m2 = (b0_post * (b0_post + 1) / ((a0_post + b0_post) * (a0_post + b0_post + 1))) \
+         * (b1_post * (b1_post + 1) / ((a1_post + b1_post) * (a1_post + b1_post + 1)))
+    w_nu = w_m1 * (1 - w_m1) / (w_m2 - w_m1**2) - 1
+    # p_12 = 1 - w, so the matched Beta(a, b) of w enters with its parameters swapped
+    a12_post = (1 - w_m1) * w_nu
+    b12_post = w_m1 * w_nu
+    q = np.array([[0.05], [0.5], [0.95]])
+    quantiles = betaincinv(np.concatenate([a0_post, a12_post]), np.concatenate([b0_post, b12_post]), q)
+    n_states = len(posterior)
+    posterior = posterior.assign(
+        p_02_low_90=np.round(quantiles[0, :n_states], 3),
+        p_02_median=np.round(quantiles[1, :n_states], 3),
+        p_02_high_90=np.round(quantiles[2, :n_states], 3),
+        p_12_low_90=np.round(quantiles[0, n_states:], 3),
+        p_12_median=np.round(quantiles[1, n_states:], 3),
+        p_12_high_90=np.round(quantiles[2, n_states:], 3),
+    )
+    return posterior
+
+
+def apply_backfill_correction(latest_df: pd.DataFrame, posterior: pd.DataFrame,
+                              latest_date, latest_minus1_date) -> pd.DataFrame:
+    """
+    Scale the two most recent weeks of the latest snapshot up by the estimated completeness
+
+    input
+    -----
+
+    latest_df: pd.DataFrame
+        Latest preliminary snapshot (full schema).
+
+    posterior: pd.DataFrame
+        Per-state completeness estimates (see `estimate_backfill_posterior()`).
+
+    latest_date: datetime
+    latest_minus1_date: datetime
+        The two most recent reporting dates in `latest_df`.
+
+    output
+    ------
+
+    latest_df: pd.DataFrame
+        Copy of the latest snapshot with 'influenza admissions' backfilled on the last two weeks.
+
+    notes
+    -----
+
+    A jurisdiction in the latest snapshot without a completeness estimate (e.g. one that starts
+    reporting mid-season and has no complete backfill window yet) is left uncorrected and flagged
+    with a warning.
+    """
+
+    # look the per-state completeness up through positional codes instead of a ~50-row merge;
+    # a plain hash lookup per row, and no merged-frame copy to allocate and drop again
+    # (the index is built from the values so the codes match the posterior's row order, also
+    # when 'name_state' itself is categorical; states without an estimate get code -1)
+    state_codes = pd.Index(posterior['name_state'].to_numpy()).get_indexer(latest_df['name_state'].to_numpy())
+    p_02 = posterior['p_02_mean'].to_numpy()[state_codes]
+    p_12 = posterior['p_12_mean'].to_numpy()[state_codes]
+
+    # build one per-row multiplier and scale in a single pass instead of two masked in-place scans;
+    # rows with code -1 would index an arbitrary state's completeness, so keep them at scale 1
+    dates = latest_df['date'].to_numpy()
+    valid = state_codes >= 0
+    if not valid.all():
+        missing = sorted(set(latest_df['name_state'].to_numpy()[~valid]))
+        warnings.warn(f"no backfill estimate available for {missing}; left uncorrected")
+    scale = np.ones(len(latest_df))
+    mask_0 = valid & (dates == latest_date)
+    mask_1 = valid & (dates == latest_minus1_date)
+    scale[mask_0] = 1/p_02[mask_0]
+    scale[mask_1] = 1/p_12[mask_1]
+    return latest_df.assign(**{'influenza admissions': latest_df['influenza admissions'].to_numpy() * scale})